@@ -1,9 +1,19 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 DATABASE_URL = "sqlite:///./users.db"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+# Sync endpoints run on FastAPI's threadpool; size the pool so sessions don't queue
+# for a connection, and skip pre-ping (local SQLite connections don't go stale).
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=20,
+    max_overflow=20,
+    pool_pre_ping=False,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
@@ -1,15 +1,23 @@
 import os
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Form
+import asyncio
+from typing import List, Optional
+import aiofiles
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Form, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, FileResponse
 from pydantic import BaseModel
+from sqlalchemy import inspect, select
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from passlib.context import CryptContext
 import traceback
 
 from database import SessionLocal, engine
 from models import Base, User
-from rag_pipeline import get_response_stream, add_new_document, load_user_index, delete_user_document
+from rag_pipeline import (
+    get_response_stream, add_new_documents, load_user_index, delete_user_document, update_metadata,
+    is_orphaned_upload, recover_stale_uploads, track_upload, untrack_upload
+)
 
 # --------------------------
 # App & Config
@@ -18,6 +26,12 @@ app = FastAPI(title="RAG Educational Assistant", version="1.0.0")
 
 Base.metadata.create_all(bind=engine)
 
+# Logins look users up by username; make sure that lookup is an indexed one
+if not any(
+    ix["column_names"] == ["username"] and ix["unique"] for ix in inspect(engine).get_indexes("users")
+):
+    print("⚠️ users.username has no unique index — logins will scan the whole table.")
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all during dev; tighten in production
@@ -26,7 +40,21 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 10 rounds (~4x cheaper than the default 12); hashes made with 12 rounds still verify
+pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=10, deprecated="auto")
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # stream uploads to disk 1 MiB at a time
+
+
+@app.on_event("startup")
+async def resume_interrupted_uploads():
+    """Re-index uploads a previous run left in "indexing", without delaying startup."""
+    def recover_all():
+        for name in os.listdir("data") if os.path.isdir("data") else []:
+            if name.isdigit():
+                recover_stale_uploads(int(name))
+
+    asyncio.get_running_loop().run_in_executor(None, recover_all)
 
 
 # --------------------------
@@ -55,18 +83,21 @@ class Question(BaseModel):
 def serve_index():
     path = os.path.join("frontend", "index.html")
     if os.path.exists(path):
-        with open(path, "r", encoding="utf-8") as f:
-            return f.read()
+        return FileResponse(path, media_type="text/html")
     return "<h1>index.html not found</h1>"
 
 
 # --------------------------
 # Auth Endpoints
 # --------------------------
+def get_user_by_username(db: Session, username: str):
+    return db.execute(select(User).where(User.username == username)).scalar_one_or_none()
+
+
 @app.post("/register")
 def register(username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
     """Register new user with hashed password."""
-    if db.query(User).filter(User.username == username).first():
+    if get_user_by_username(db, username):
         raise HTTPException(status_code=400, detail="Username already exists")
 
     hashed_pw = pwd_context.hash(password)
@@ -85,7 +116,7 @@ def register(username: str = Form(...), password: str = Form(...), db: Session =
 @app.post("/login")
 def login(username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
     """User login verification."""
-    user = db.query(User).filter(User.username == username).first()
+    user = get_user_by_username(db, username)
     if not user or not pwd_context.verify(password, user.hashed_password):
         raise HTTPException(status_code=401, detail="Invalid username or password")
     return {"message": "Login successful", "user_id": user.id}
@@ -94,36 +125,70 @@ def login(username: str = Form(...), password: str = Form(...), db: Session = De
 # --------------------------
 # File Upload Endpoint
 # --------------------------
+async def index_documents(file_paths: List[str], user_id: int):
+    """
+    Chunk + embed uploaded files off the event loop, recording the outcome in metadata.
+    Index writes are serialized per user inside rag_pipeline.
+    """
+    try:
+        indexed = await run_in_threadpool(add_new_documents, file_paths, user_id)
+        for file_path in file_paths:
+            if file_path not in indexed:
+                await run_in_threadpool(update_metadata, user_id, file_path, 0, "failed")
+    finally:
+        for file_path in file_paths:
+            untrack_upload(user_id, os.path.basename(file_path))
+
+
 @app.post("/upload")
-async def upload_file(user_id: int = Form(...), file: UploadFile = File(...)):
+async def upload_file(
+    background_tasks: BackgroundTasks,
+    user_id: int = Form(...),
+    file: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+):
     """
-    Upload a new document (PDF/TXT/CSV) for a user.
-    The file is saved in their folder and automatically chunked + indexed.
+    Upload one document (`file`) or several (`files`) for a user.
+    Files are saved in their folder and queued for chunking + indexing; multiple files
+    are embedded together in one batch. Progress is reported through the `status`
+    field of /user/{user_id}/docs.
     """
+    file_paths = []
     try:
+        uploads = ([file] if file else []) + (files or [])
+        if not uploads:
+            raise HTTPException(status_code=400, detail="No file uploaded")
+
         user_dir = os.path.join("data", str(user_id))
         os.makedirs(user_dir, exist_ok=True)
 
-        # Save file locally
-        file_path = os.path.join(user_dir, file.filename)
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-
-        # Process and embed document
-        processed = add_new_document(file_path, user_id)
-        if processed:
-            return JSONResponse({
-                "status": "success",
-                "message": f"{file.filename} uploaded and indexed successfully."
-            })
-        else:
-            return JSONResponse({
-                "status": "error",
-                "message": f"{file.filename} uploaded but could not be processed."
-            })
+        # Save files locally in fixed-size chunks so large uploads aren't held in memory.
+        # Each file is tracked as in flight until index_documents finishes with it, so its
+        # "indexing" entry isn't mistaken for one orphaned by a crash.
+        for upload in uploads:
+            file_path = os.path.join(user_dir, upload.filename)
+            track_upload(user_id, upload.filename)
+            file_paths.append(file_path)
+            async with aiofiles.open(file_path, "wb") as f:
+                while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+            await run_in_threadpool(update_metadata, user_id, file_path, 0, "indexing")
+
+        # Process and embed documents after the response is sent
+        background_tasks.add_task(index_documents, file_paths, user_id)
+        names = ", ".join(upload.filename for upload in uploads)
+        return JSONResponse({
+            "status": "queued",
+            "message": f"{names} uploaded; indexing in background."
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         print("❌ Error in /upload:", e)
         traceback.print_exc()
+        # Nothing was queued, so nothing else will clear these
+        for file_path in file_paths:
+            untrack_upload(user_id, os.path.basename(file_path))
         return JSONResponse({"status": "error", "message": str(e)})
 
 
@@ -156,10 +221,7 @@ def ask_question_json(q: Question):
     Useful for frontends that expect a single JSON payload.
     """
     try:
-        stream = get_response_stream(q.user_id, q.question)
-        full_answer = ""
-        for chunk in stream:
-            full_answer += chunk
+        full_answer = "".join(get_response_stream(q.user_id, q.question))
         return {"answer": full_answer}
     except Exception as e:
         print("❌ Error in /ask_json:", e)
@@ -172,9 +234,11 @@ def ask_question_json(q: Question):
 # Optional: Debug / Utility
 # --------------------------
 @app.get("/user/{user_id}/docs")
-def list_user_docs(user_id: int):
+def list_user_docs(user_id: int, background_tasks: BackgroundTasks):
     """
-    View metadata of uploaded documents for a user.
+    View metadata of uploaded documents for a user, including each file's
+    indexing `status` ("indexing", "indexed" or "failed").
+    Uploads left in "indexing" with no task indexing them are re-queued.
     Useful for debugging / frontend display.
     """
     metadata_path = os.path.join("data", str(user_id), "metadata.json")
@@ -182,20 +246,23 @@ def list_user_docs(user_id: int):
         return {"message": "No documents uploaded yet."}
     with open(metadata_path, "r", encoding="utf-8") as f:
         import json
-        return json.load(f)
+        metadata = json.load(f)
+    if any(is_orphaned_upload(user_id, m) for m in metadata):
+        background_tasks.add_task(recover_stale_uploads, user_id)
+    return metadata
 
 
 # --------------------------
 # Delete User Document
 # --------------------------
 @app.delete("/user/{user_id}/docs")
-def delete_doc(user_id: int, filename: str):
+async def delete_doc(user_id: int, filename: str):
     """
     Delete a specific user document by filename and rebuild the user's index.
     The `filename` should match the stored file name exactly.
     """
     try:
-        ok = delete_user_document(user_id, filename)
+        ok = await run_in_threadpool(delete_user_document, user_id, filename)
         if ok:
             return {"status": "success", "message": f"Deleted {filename} and rebuilt index"}
         else:
@@ -0,0 +1,12 @@
+"""
+PDF page extraction run in worker processes.
+Kept free of the RAG pipeline imports so workers start without loading the embedding model.
+"""
+import fitz  # PyMuPDF
+
+
+def extract_pages(page_range):
+    """Extract text for a (file_path, start, stop) page range of a PDF."""
+    file_path, start, stop = page_range
+    with fitz.open(file_path) as doc:
+        return [doc[i].get_text() for i in range(start, stop)]
@@ -5,62 +5,299 @@ import faiss
 import numpy as np
 from sentence_transformers import SentenceTransformer
 import ollama
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 import torch
 import pickle
+import pyarrow as pa
+import pyarrow.compute as pc
 import traceback
 from datetime import datetime
 import json
+import time
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import pdf_worker
 
 # ==== CONFIG ====
 BASE_DIR = "data"
 DIM = 384
 MODEL_NAME = "all-MiniLM-L6-v2"
-RELEVANCE_THRESHOLD = 1.2
+RELEVANCE_THRESHOLD = 1.2  # max L2 distance, for indexes built before the switch to cosine
+COSINE_THRESHOLD = 0.4  # min cosine similarity; same cut-off as L2 1.2 on unit vectors
 METADATA_FILE = "metadata.json"
+CHUNK_IDS_FILE = "chunk_ids.json"  # {filename: [FAISS ids]} for id-based deletes
+LEGACY_CHUNKS_FILE = "chunks.pkl"
+CHUNK_SCHEMA = pa.schema([("id", pa.int64()), ("chunk", pa.large_string())])
+IVF_MIN_CHUNKS = 10000  # PQ needs ~39 x 256 = 9984 training points; below this a flat scan is cheap
+IVF_RETRAIN_FACTOR = 2  # retrain once the corpus wants this many times the trained nlist (~4x the vectors)
+PQ_M = 48  # sub-quantizers for IVFPQ (DIM must be divisible by this)
+PQ_NBITS = 8
+NPROBE = 8
+# Pre-quantized INT8 ONNX exports shipped in the model repo, by CPU capability
+ONNX_MODEL_FILES = {
+    "AVX512": "onnx/model_qint8_avx512.onnx",
+    "AVX2": "onnx/model_quint8_avx2.onnx",
+}
+STREAM_FLUSH_CHARS = 64  # batch streamed tokens into sends of at least this size...
+STREAM_FLUSH_SECONDS = 0.05  # ...or whatever arrived within this interval
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 100
+# Split points, strongest first: paragraph, line, sentence end, word
+SEPARATORS = (("\n\n",), ("\n",), (". ", "! ", "? "), (" ",))
+PDF_PARALLEL_MIN_PAGES = 50  # smaller PDFs aren't worth the worker startup
+MAX_SEQ_LENGTH = 256  # MiniLM's trained limit; avoids padding further
+INDEX_CACHE_SIZE = 64  # users whose index + chunks stay loaded (least recently used evicted)
 
 # ==== INIT ====
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"✅ Using device: {device}")
-embed_model = SentenceTransformer(MODEL_NAME, device=device)
+
+
+def load_embed_model():
+    """Load the embedding model: FP16 PyTorch on CUDA, INT8 ONNX Runtime on CPU when available."""
+    if device == "cpu":
+        get_capability = getattr(torch.backends.cpu, "get_cpu_capability", lambda: "DEFAULT")
+        capability = get_capability()
+        file_name = next(
+            (f for prefix, f in ONNX_MODEL_FILES.items() if capability.startswith(prefix)),
+            "onnx/model.onnx",
+        )
+        try:
+            model = SentenceTransformer(
+                MODEL_NAME, device=device, backend="onnx", model_kwargs={"file_name": file_name}
+            )
+            print(f"✅ Using ONNX Runtime embeddings ({file_name})")
+            return model
+        except Exception as e:
+            print(f"⚠️ ONNX backend unavailable ({str(e)}) — falling back to PyTorch.")
+        return SentenceTransformer(MODEL_NAME, device=device)
+
+    model = SentenceTransformer(MODEL_NAME, device=device)
+    # FP16 needs tensor cores (Volta, compute capability 7.0+) to pay off; older GPUs stay FP32
+    major, _ = torch.cuda.get_device_capability()
+    if major >= 7:
+        model.half()
+    print(f"✅ Embedding weights: {model[0].auto_model.dtype}")
+    return model
+
+
+embed_model = load_embed_model()
+embed_model.max_seq_length = MAX_SEQ_LENGTH
+ENCODE_BATCH_SIZE = 128 if device == "cuda" else 64
+
+# Flat/SQ scans are SIMD- and thread-bound: use every core, and report which SIMD
+# build was loaded (faiss-cpu wheels pick the AVX2/AVX-512 variant at import).
+faiss.omp_set_num_threads(os.cpu_count() or 1)
+faiss_build = faiss.get_compile_options()
+print(f"✅ FAISS build: {faiss_build} ({faiss.omp_get_max_threads()} threads)")
+if "AVX2" not in faiss_build and "AVX512" not in faiss_build:
+    print("⚠️ FAISS loaded without AVX2/AVX-512 kernels — vector search will be slower.")
+# Searches run on the GPU when FAISS was built with CUDA support (faiss-gpu)
+faiss_gpu_res = faiss.StandardGpuResources() if device == "cuda" and hasattr(faiss, "StandardGpuResources") else None
+# StandardGpuResources (and GPU indexes using it) are not thread-safe; the threadpool
+# serializes GPU copies and searches through this lock
+faiss_gpu_lock = threading.Lock() if faiss_gpu_res is not None else nullcontext()
+
+# user_id -> ((index mtime, chunks mtime), index, chunk table), in LRU order
+_index_cache = OrderedDict()
+_index_cache_lock = threading.Lock()
+# Guards metadata.json read-modify-write; uploads record status while indexing runs
+_metadata_lock = threading.Lock()
+# Users whose index is being rebuilt after a vector/chunk count mismatch
+_repairing_users = set()
+_repair_lock = threading.Lock()
+# Users whose interrupted uploads are being re-indexed (see recover_stale_uploads)
+_recovering_users = set()
+# (user_id, filename) -> uploads saved by this process and not yet done indexing
+_inflight_uploads = Counter()
+_inflight_lock = threading.Lock()
+# Shared process pool for extracting large PDFs (created lazily by _get_pdf_pool)
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+# Serialize index writes (uploads, deletes, background repairs) per user
+_user_index_locks = {}
+_user_index_locks_guard = threading.Lock()
 
 
 # -------------------------------------------------
 # Utility Functions
 # -------------------------------------------------
+def user_index_lock(user_id):
+    """Re-entrant lock held while a user's index and chunk files are read-modified-written."""
+    with _user_index_locks_guard:
+        return _user_index_locks.setdefault(str(user_id), threading.RLock())
+
+
 def get_user_dirs(user_id):
     """Return user directory, chunk cache path, and FAISS index path."""
     user_dir = os.path.join(BASE_DIR, str(user_id))
-    vector_cache = os.path.join(user_dir, "chunks.pkl")
+    vector_cache = os.path.join(user_dir, "chunks.arrow")
     index_path = os.path.join(user_dir, "faiss.index")
     os.makedirs(user_dir, exist_ok=True)
     return user_dir, vector_cache, index_path
 
 
-def update_metadata(user_id, file_path, num_chunks):
-    """Store metadata for uploaded documents (filename, time, chunk count)."""
+def update_metadata(user_id, file_path, num_chunks, status="indexed"):
+    """
+    Store metadata for uploaded documents (filename, time, chunk count, indexing status).
+    An entry still marked "indexing" for the same file is updated in place.
+    """
     user_dir, _, _ = get_user_dirs(user_id)
     metadata_path = os.path.join(user_dir, METADATA_FILE)
+    filename = os.path.basename(file_path)
 
-    metadata = []
-    if os.path.exists(metadata_path):
-        try:
-            with open(metadata_path, "r", encoding="utf-8") as f:
-                metadata = json.load(f)
-        except Exception:
-            metadata = []
+    with _metadata_lock:
+        metadata = []
+        if os.path.exists(metadata_path):
+            try:
+                with open(metadata_path, "r", encoding="utf-8") as f:
+                    metadata = json.load(f)
+            except Exception:
+                metadata = []
 
-    metadata.append({
-        "file": os.path.basename(file_path),
-        "chunks": num_chunks,
-        "uploaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
+        pending = next(
+            (m for m in reversed(metadata) if m.get("file") == filename and m.get("status") == "indexing"),
+            None,
+        )
+        if pending is not None:
+            pending["chunks"] = num_chunks
+            pending["status"] = status
+        else:
+            metadata.append({
+                "file": filename,
+                "chunks": num_chunks,
+                "status": status,
+                "uploaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            })
 
-    with open(metadata_path, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2)
+        with open(metadata_path, "w", encoding="utf-8") as f:
+            json.dump(metadata, f, indent=2)
     print(f"🗂️ Metadata updated for user {user_id} ({len(metadata)} total uploads)")
 
 
+def track_upload(user_id, filename):
+    """Register an upload as in flight; call before its metadata is marked "indexing"."""
+    with _inflight_lock:
+        _inflight_uploads[(str(user_id), filename)] += 1
+
+
+def untrack_upload(user_id, filename):
+    """Mark an upload's indexing task as finished (whatever the outcome)."""
+    with _inflight_lock:
+        key = (str(user_id), filename)
+        _inflight_uploads[key] -= 1
+        if _inflight_uploads[key] <= 0:
+            del _inflight_uploads[key]
+
+
+def is_pending_upload(user_id, entry):
+    """Whether a metadata entry is an upload this process is still indexing."""
+    if entry.get("status") != "indexing":
+        return False
+    with _inflight_lock:
+        return (str(user_id), entry.get("file")) in _inflight_uploads
+
+
+def is_orphaned_upload(user_id, entry):
+    """An "indexing" entry no indexing task owns any more (e.g. the server stopped mid-way)."""
+    return entry.get("status") == "indexing" and not is_pending_upload(user_id, entry)
+
+
+def _get_pdf_pool():
+    """
+    Return the long-lived PDF extraction pool, creating it on first use.
+    Workers come from a forkserver (spawn where unavailable) rather than fork, which is
+    unsafe in this multithreaded process; they only import pdf_worker, not this module.
+    """
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if ctx.get_start_method() == "forkserver":
+                ctx.set_forkserver_preload(["pdf_worker"])
+            _pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=ctx)
+        return _pdf_pool
+
+
+def extract_pdf_text(file_path):
+    """Extract PDF text, splitting large documents across worker processes."""
+    global _pdf_pool
+    with fitz.open(file_path) as doc:
+        page_count = doc.page_count
+        if page_count < PDF_PARALLEL_MIN_PAGES:
+            return "\n".join(page.get_text() for page in doc)
+
+    # PyMuPDF is not thread-safe, so parallelize with processes, each opening its own handle
+    workers = min(os.cpu_count() or 1, page_count)
+    step = -(-page_count // workers)
+    ranges = [(file_path, start, min(start + step, page_count)) for start in range(0, page_count, step)]
+    try:
+        parts = _get_pdf_pool().map(pdf_worker.extract_pages, ranges)
+        return "\n".join(text for part in parts for text in part)
+    except BrokenProcessPool as e:
+        print(f"⚠️ PDF worker pool died, extracting {os.path.basename(file_path)} serially: {str(e)}")
+        with _pdf_pool_lock:
+            _pdf_pool = None
+        return "\n".join(pdf_worker.extract_pages((file_path, 0, page_count)))
+
+
+def read_delimited(file_path, sep=","):
+    """
+    Read a CSV/TSV as strings with the multithreaded pyarrow parser, falling back to the
+    C engine for files it rejects (e.g. duplicate headers on pandas 3).
+    """
+    try:
+        return pd.read_csv(file_path, sep=sep, engine="pyarrow", dtype=str, keep_default_na=False)
+    except Exception as e:
+        print(f"⚠️ pyarrow CSV parser failed, retrying with the C engine: {str(e)}")
+        return pd.read_csv(file_path, sep=sep, dtype=str, keep_default_na=False)
+
+
+def dataframe_to_text(df):
+    """Flatten a table into one ' | '-joined line per row (column-wise, no per-row calls)."""
+    if df.empty:
+        return ""
+    cols = [df.iloc[:, i].fillna("").astype(str) for i in range(df.shape[1])]
+    rows = cols[0].str.cat(cols[1:], sep=" | ") if len(cols) > 1 else cols[0]
+    return rows.str.cat(sep="\n")
+
+
+def split_text(text, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP):
+    """
+    Split text into chunks of at most chunk_size characters.
+    Each chunk ends at the last paragraph break in its window, else the last line break,
+    sentence end or space (searched with str.rfind, once per chunk). Unless it ended at a
+    paragraph break, the next chunk starts up to chunk_overlap characters back, on a word boundary.
+    """
+    chunks = []
+    start = 0
+    while start < len(text):
+        window = text[start:start + chunk_size]
+        cut, overlap = len(window), chunk_overlap
+        if start + chunk_size < len(text):
+            for level, seps in enumerate(SEPARATORS):
+                # Cutting inside the overlap would not move the next chunk forward
+                pos = max(window.rfind(sep) for sep in seps)
+                if pos != -1 and pos + len(seps[0]) > chunk_overlap:
+                    cut = pos + len(seps[0])
+                    # A paragraph is a clean break; carry no overlap across it
+                    overlap = 0 if level == 0 else chunk_overlap
+                    break
+        chunk = window[:cut].strip()
+        if chunk:
+            chunks.append(chunk)
+        if start + cut >= len(text):
+            break
+        space = text.find(" ", start + cut - overlap, start + cut) if overlap else -1
+        start = space + 1 if space != -1 else start + cut
+    return chunks
+
+
 def chunk_file(file_path):
     """Extract text from supported files and split into semantic chunks."""
     try:
@@ -70,24 +307,23 @@ def chunk_file(file_path):
 
         if ext == "pdf":
             print(f"📄 Loading PDF: {filename}")
-            doc = fitz.open(file_path)
-            text = "\n".join(page.get_text() for page in doc)
+            text = extract_pdf_text(file_path)
         elif ext == "txt":
             print(f"📜 Loading TXT: {filename}")
             with open(file_path, "r", encoding="utf-8") as f:
                 text = f.read()
         elif ext == "csv":
             print(f"📊 Loading CSV: {filename}")
-            df = pd.read_csv(file_path)
-            text = "\n".join(df.astype(str).apply(lambda x: " | ".join(x), axis=1))
+            df = read_delimited(file_path)
+            text = dataframe_to_text(df)
         elif ext == "tsv":
             print(f"📊 Loading TSV: {filename}")
-            df = pd.read_csv(file_path, sep="\t")
-            text = "\n".join(df.astype(str).apply(lambda x: " | ".join(x), axis=1))
+            df = read_delimited(file_path, sep="\t")
+            text = dataframe_to_text(df)
         elif ext == "xlsx":
             print(f"📊 Loading XLSX: {filename}")
-            df = pd.read_excel(file_path, engine="openpyxl")
-            text = "\n".join(df.astype(str).apply(lambda x: " | ".join(x), axis=1))
+            df = pd.read_excel(file_path, engine="openpyxl", dtype=str, keep_default_na=False)
+            text = dataframe_to_text(df)
         elif ext == "docx":
             print(f"📝 Loading DOCX: {filename}")
             try:
@@ -119,12 +355,7 @@ def chunk_file(file_path):
             print(f"⚠️ No readable text found in {filename}")
             return []
 
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=800,
-            chunk_overlap=100,
-            separators=["\n\n", "\n", ".", "!", "?", " "]
-        )
-        chunks = splitter.split_text(text)
+        chunks = split_text(text)
         print(f"✅ {len(chunks)} chunks created from {filename}")
         return chunks
 
@@ -134,15 +365,159 @@ def chunk_file(file_path):
         return []
 
 
-def build_faiss_index(chunks):
-    """Build FAISS index from chunks."""
+def encode_chunks(chunks):
+    """Embed document chunks as unit-length vectors using the tuned batch size."""
+    # SentenceTransformer.encode already sorts inputs by length internally
+    # (and restores the original order), so batches carry minimal padding.
+    return embed_model.encode(
+        chunks,
+        batch_size=ENCODE_BATCH_SIZE,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
+
+
+def ivf_nlist(n):
+    """Inverted lists for n vectors: 4*sqrt(n), capped so k-means has ~39 points per centroid."""
+    return max(32, min(int(4 * np.sqrt(n)), n // 39))
+
+
+def create_faiss_index(embeddings):
+    """
+    Create an empty (trained) FAISS index sized for the given embeddings.
+    Embeddings are unit-length, so inner product is cosine similarity.
+    """
+    n = len(embeddings)
+    if n < IVF_MIN_CHUNKS:
+        # 8-bit scalar quantization: 4x smaller than FP32. Unit-length vectors have every
+        # component in [-1, 1], so train on those bounds rather than on the first batch —
+        # a range learned from one small upload would clip every later append.
+        index = faiss.IndexScalarQuantizer(DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(np.vstack([np.full(DIM, -1.0), np.full(DIM, 1.0)]).astype(np.float32))
+        return index
+
+    nlist = ivf_nlist(n)
+    print(f"🧮 Training IVFPQ index (nlist={nlist}, M={PQ_M}) on {n} vectors...")
+    quantizer = faiss.IndexFlatIP(DIM)
+    index = faiss.IndexIVFPQ(quantizer, DIM, nlist, PQ_M, PQ_NBITS, faiss.METRIC_INNER_PRODUCT)
+    index.train(np.ascontiguousarray(embeddings, dtype=np.float32))
+    return index
+
+
+def with_chunk_ids(index):
+    """
+    Make an empty index label its vectors with chunk ids.
+    IVF indexes store ids themselves and keep them on remove_ids; flat-code indexes
+    renumber on removal, so they go behind an IndexIDMap2.
+    """
+    if faiss.try_extract_index_ivf(index) is not None:
+        return index
+    return faiss.IndexIDMap2(index)
+
+
+def has_chunk_ids(index):
+    """Whether the index's labels are chunk ids that add_with_ids/remove_ids keep intact."""
+    if isinstance(index, faiss.IndexIDMap2):
+        return not is_misnumbered_ivf(index)
+    return isinstance(index, faiss.IndexIVF)
+
+
+def is_misnumbered_ivf(index):
+    """
+    An IVF index under an IndexIDMap2 (written by earlier versions): remove_ids compacts
+    the id map but IVF doesn't renumber, so labels after a delete point at the wrong chunks.
+    """
+    return isinstance(index, faiss.IndexIDMap2) and faiss.try_extract_index_ivf(index) is not None
+
+
+def upgrade_to_ivf(index):
+    """
+    Re-create an ID-mapped index as IVFPQ once appends have grown it past IVF_MIN_CHUNKS.
+    Vectors are reconstructed from the existing index, so nothing is re-embedded.
+    """
+    vectors = index.index.reconstruct_n(0, index.ntotal)
+    ids = faiss.vector_to_array(index.id_map)
+    upgraded = with_chunk_ids(create_faiss_index(vectors))
+    upgraded.add_with_ids(vectors, ids)
+    return upgraded
+
+
+def make_chunk_table(ids, texts):
+    """Build the Arrow chunk table (ids must be ascending)."""
+    return pa.table({
+        "id": pa.array(ids, type=pa.int64()),
+        "chunk": pa.array(texts, type=pa.large_string()),
+    }, schema=CHUNK_SCHEMA)
+
+
+def lookup_chunks(table, ids):
+    """Return chunk texts for the given FAISS ids, skipping ids not in the table."""
+    all_ids = table.column("id").to_numpy()
+    texts = table.column("chunk")
+    ids = np.asarray(ids, dtype=np.int64)
+    positions = np.searchsorted(all_ids, ids)
+    return [
+        texts[int(pos)].as_py()
+        for i, pos in zip(ids, positions)
+        if pos < len(all_ids) and all_ids[pos] == i
+    ]
+
+
+def drop_chunks(table, ids):
+    """Return the chunk table without the given ids."""
+    removed = pc.is_in(table.column("id"), value_set=pa.array(ids, type=pa.int64()))
+    return table.filter(pc.invert(removed))
+
+
+def write_chunk_table(path, table):
+    """Write the chunk table as an Arrow IPC file, replacing any previous file atomically."""
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, CHUNK_SCHEMA) as writer:
+            writer.write_table(table.combine_chunks())
+    # New inode, so readers still mapping the old file are unaffected
+    os.replace(tmp_path, path)
+
+
+def read_chunk_table(path):
+    """Memory-map the chunk table; strings are only materialized when accessed."""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _migrate_legacy_chunks(user_dir, vector_cache):
+    """Convert an older pickled chunk cache (list or {id: text}) to the Arrow file."""
+    legacy_path = os.path.join(user_dir, LEGACY_CHUNKS_FILE)
+    if os.path.exists(vector_cache) or not os.path.exists(legacy_path):
+        return
+    try:
+        with open(legacy_path, "rb") as f:
+            chunks = pickle.load(f)
+        if isinstance(chunks, list):
+            chunks = dict(enumerate(chunks))
+        items = sorted(chunks.items())
+        write_chunk_table(vector_cache, make_chunk_table([i for i, _ in items], [t for _, t in items]))
+        os.remove(legacy_path)
+        print(f"🔁 Migrated {len(items)} pickled chunks to {vector_cache}")
+    except Exception as e:
+        print(f"⚠️ Failed to migrate legacy chunk cache: {str(e)}")
+
+
+def build_faiss_index(chunks, ids=None):
+    """Build a FAISS index labelled by chunk id from chunks (ids default to 0..n-1)."""
     try:
         if not chunks:
             return None, None, None
         print(f"🔢 Encoding {len(chunks)} chunks into embeddings...")
-        embeddings = embed_model.encode(chunks, convert_to_numpy=True, show_progress_bar=False)
-        index = faiss.IndexFlatL2(DIM)
-        index.add(np.array(embeddings))
+        embeddings = encode_chunks(chunks)
+        if ids is None:
+            ids = np.arange(len(chunks))
+        index = with_chunk_ids(create_faiss_index(embeddings))
+        index.add_with_ids(
+            np.ascontiguousarray(embeddings, dtype=np.float32),
+            np.asarray(ids, dtype=np.int64),
+        )
         return index, embeddings, chunks
     except Exception as e:
         print(f"❌ Error building FAISS index: {str(e)}")
@@ -150,13 +525,32 @@ def build_faiss_index(chunks):
         return None, None, None
 
 
-def save_user_index(user_id, index, chunks):
-    """Save FAISS index and chunks for a user."""
+def load_chunk_ids(user_id):
+    """Return the {filename: [chunk ids]} sidecar, or None if it is missing/unreadable."""
+    user_dir, _, _ = get_user_dirs(user_id)
+    ids_path = os.path.join(user_dir, CHUNK_IDS_FILE)
+    if not os.path.exists(ids_path):
+        return None
+    try:
+        with open(ids_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Failed to read chunk id map: {str(e)}")
+        return None
+
+
+def save_user_index(user_id, index, chunks, chunk_ids=None):
+    """Save FAISS index, chunk table and optionally the per-file chunk id map."""
     try:
         user_dir, vector_cache, index_path = get_user_dirs(user_id)
-        with open(vector_cache, "wb") as f:
-            pickle.dump(chunks, f)
-        faiss.write_index(index, index_path)
+        write_chunk_table(vector_cache, chunks)
+        # Replace atomically: cached indexes may still be memory-mapping the old file
+        faiss.write_index(index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        if chunk_ids is not None:
+            with open(os.path.join(user_dir, CHUNK_IDS_FILE), "w", encoding="utf-8") as f:
+                json.dump(chunk_ids, f)
+        evict_cached_index(user_id)
         print(f"💾 Saved FAISS index & {len(chunks)} chunks for user {user_id}")
     except Exception as e:
         print(f"❌ Failed to save index: {str(e)}")
@@ -164,13 +558,15 @@ def save_user_index(user_id, index, chunks):
 
 
 def clear_user_index(user_id):
-    """Remove index and chunk cache files for a user if present."""
+    """Remove index, chunk cache and chunk id map files for a user if present."""
     user_dir, vector_cache, index_path = get_user_dirs(user_id)
+    ids_path = os.path.join(user_dir, CHUNK_IDS_FILE)
+    legacy_path = os.path.join(user_dir, LEGACY_CHUNKS_FILE)
+    evict_cached_index(user_id)
     try:
-        if os.path.exists(vector_cache):
-            os.remove(vector_cache)
-        if os.path.exists(index_path):
-            os.remove(index_path)
+        for path in (vector_cache, legacy_path, index_path, ids_path):
+            if os.path.exists(path):
+                os.remove(path)
         print(f"🧹 Cleared vector cache and index for user {user_id}")
     except Exception as e:
         print(f"⚠️ Failed to clear index files: {str(e)}")
@@ -179,7 +575,7 @@ def clear_user_index(user_id):
 def rebuild_index_from_files(user_id):
     """
     Rebuild user's FAISS index by re-processing all remaining files listed in metadata.json.
-    If no files remain, clears the index/chunk cache.
+    If no files remain, clears the index/chunk cache. Callers hold user_index_lock(user_id).
     """
     user_dir, _, _ = get_user_dirs(user_id)
     metadata_path = os.path.join(user_dir, METADATA_FILE)
@@ -195,23 +591,38 @@ def rebuild_index_from_files(user_id):
         metadata = []
 
     all_chunks = []
+    chunk_ids = {}
     new_metadata = []
     for entry in metadata:
+        if is_pending_upload(user_id, entry):
+            continue  # still being added by its upload; it will append itself
         file_path = os.path.join(user_dir, entry.get("file", ""))
         if not os.path.exists(file_path):
             continue
         chunks = chunk_file(file_path)
         if chunks:
+            filename = os.path.basename(file_path)
+            start = len(all_chunks)
+            chunk_ids.setdefault(filename, []).extend(range(start, start + len(chunks)))
             all_chunks.extend(chunks)
             new_metadata.append({
-                "file": os.path.basename(file_path),
+                "file": filename,
                 "chunks": len(chunks),
+                "status": "indexed",
                 "uploaded_at": entry.get("uploaded_at") or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             })
 
-    # Update metadata to reflect current chunk counts and remove missing files
-    with open(metadata_path, "w", encoding="utf-8") as f:
-        json.dump(new_metadata, f, indent=2)
+    # Update metadata to reflect current chunk counts and remove missing files,
+    # keeping uploads that are still indexing (re-read: they may have arrived meanwhile)
+    with _metadata_lock:
+        try:
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                current = json.load(f)
+        except Exception:
+            current = []
+        new_metadata += [m for m in current if is_pending_upload(user_id, m)]
+        with open(metadata_path, "w", encoding="utf-8") as f:
+            json.dump(new_metadata, f, indent=2)
 
     if not all_chunks:
         clear_user_index(user_id)
@@ -221,50 +632,83 @@ def rebuild_index_from_files(user_id):
     if index is None:
         print("❌ Rebuild failed: no index created.")
         return False
-    save_user_index(user_id, index, all_chunks)
+    save_user_index(user_id, index, make_chunk_table(range(len(all_chunks)), all_chunks), chunk_ids)
     print(f"✅ Rebuilt index for user {user_id} from {len(new_metadata)} documents, {len(all_chunks)} chunks")
     return True
 
 
 def delete_user_document(user_id: int, filename: str) -> bool:
     """
-    Delete a specific document for a user and rebuild the FAISS index from remaining documents.
+    Delete a specific document for a user and drop its vectors from the FAISS index.
+    Falls back to rebuilding from the remaining documents when chunk ids are unavailable.
     Safe even when metadata is missing or file is absent.
     """
     user_dir, _, _ = get_user_dirs(user_id)
     target_path = os.path.join(user_dir, filename)
 
-    # Remove file if exists
-    try:
-        if os.path.exists(target_path):
-            os.remove(target_path)
-            print(f"🗑️ Deleted file: {target_path}")
-    except Exception as e:
-        print(f"⚠️ Could not delete file {target_path}: {str(e)}")
-
-    # Update metadata to remove this entry
-    metadata_path = os.path.join(user_dir, METADATA_FILE)
-    if os.path.exists(metadata_path):
+    with user_index_lock(user_id):
+        # Remove file if exists
         try:
-            with open(metadata_path, "r", encoding="utf-8") as f:
-                metadata = json.load(f)
-            metadata = [m for m in metadata if m.get("file") != filename]
-            with open(metadata_path, "w", encoding="utf-8") as f:
-                json.dump(metadata, f, indent=2)
+            if os.path.exists(target_path):
+                os.remove(target_path)
+                print(f"🗑️ Deleted file: {target_path}")
         except Exception as e:
-            print(f"⚠️ Failed to update metadata after delete: {str(e)}")
+            print(f"⚠️ Could not delete file {target_path}: {str(e)}")
 
-    # Rebuild index and chunks from remaining files
-    return rebuild_index_from_files(user_id)
-def load_user_index(user_id):
-    """Load FAISS index and chunks for a user."""
+        # Update metadata to remove this entry
+        metadata_path = os.path.join(user_dir, METADATA_FILE)
+        if os.path.exists(metadata_path):
+            try:
+                with _metadata_lock:
+                    with open(metadata_path, "r", encoding="utf-8") as f:
+                        metadata = json.load(f)
+                    metadata = [m for m in metadata if m.get("file") != filename]
+                    with open(metadata_path, "w", encoding="utf-8") as f:
+                        json.dump(metadata, f, indent=2)
+            except Exception as e:
+                print(f"⚠️ Failed to update metadata after delete: {str(e)}")
+
+        # Remove the document's vectors by id; no re-embedding of the remaining files
+        index, chunks = _read_user_index(user_id)
+        chunk_ids = load_chunk_ids(user_id)
+        if index is None or chunk_ids is None or not has_chunk_ids(index):
+            print("⚠️ No chunk id map for this index — rebuilding from remaining files...")
+            return rebuild_index_from_files(user_id)
+
+        ids = chunk_ids.pop(filename, [])
+        if not ids:
+            return True
+        chunks = drop_chunks(chunks, ids)
+        if chunks.num_rows == 0:
+            clear_user_index(user_id)
+            return True
+
+        removed = index.remove_ids(np.asarray(ids, dtype=np.int64))
+        save_user_index(user_id, index, chunks, chunk_ids)
+        print(f"✅ Removed {removed} vectors for {filename} (user {user_id})")
+        return True
+
+
+def _read_user_index(user_id, mmap=False):
+    """
+    Read FAISS index and chunk table for a user from disk (uncached).
+    With mmap=True the index is memory-mapped read-only (pages shared across workers and
+    loaded on demand); otherwise it is read into memory and safe to mutate.
+    """
     user_dir, vector_cache, index_path = get_user_dirs(user_id)
+    _migrate_legacy_chunks(user_dir, vector_cache)
     if not os.path.exists(index_path) or not os.path.exists(vector_cache):
         return None, None
     try:
-        index = faiss.read_index(index_path)
-        with open(vector_cache, "rb") as f:
-            chunks = pickle.load(f)
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e:
+                print(f"⚠️ Could not memory-map index, reading it fully: {str(e)}")
+        if index is None:
+            index = faiss.read_index(index_path)
+        chunks = read_chunk_table(vector_cache)
         return index, chunks
     except Exception as e:
         print(f"⚠️ Failed to load user index: {str(e)} — will rebuild.")
@@ -272,58 +716,262 @@ def load_user_index(user_id):
         return None, None
 
 
+def _prepare_for_search(index):
+    """Apply query-time settings and move the index to the GPU when available."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = NPROBE
+    if faiss_gpu_res is not None:
+        try:
+            with faiss_gpu_lock:
+                index = faiss.index_cpu_to_gpu(faiss_gpu_res, 0, index)
+        except Exception as e:
+            print(f"⚠️ Could not move index to GPU, searching on CPU: {str(e)}")
+    return index
+
+
+def _repair_index(user_id):
+    """
+    Re-embed a user's chunks into a fresh index (runs in a background thread).
+    Holds the user's index lock so uploads and deletes can't interleave with the rebuild;
+    the files are re-read under it in case a concurrent write already fixed the mismatch.
+    """
+    try:
+        with user_index_lock(user_id):
+            index, chunks = _read_user_index(user_id)
+            if index is None or (index.ntotal == chunks.num_rows and not is_misnumbered_ivf(index)):
+                print(f"✅ Index for user {user_id} is consistent again — skipping rebuild.")
+                return
+            print(f"🧱 Rebuilding FAISS index for user {user_id} in background...")
+            index, _, _ = build_faiss_index(chunks.column("chunk").to_pylist(), chunks.column("id").to_numpy())
+            if index:
+                save_user_index(user_id, index, chunks)
+                print("✅ Index rebuilt successfully.")
+            else:
+                print("❌ Index rebuild failed.")
+    except Exception as e:
+        print(f"❌ Background index rebuild failed: {str(e)}")
+        traceback.print_exc()
+    finally:
+        with _repair_lock:
+            _repairing_users.discard(str(user_id))
+
+
+def is_index_repairing(user_id):
+    """Whether the user's index is currently being rebuilt in the background."""
+    return str(user_id) in _repairing_users
+
+
+def evict_cached_index(user_id):
+    """Drop a user's loaded index from the in-memory cache."""
+    with _index_cache_lock:
+        _index_cache.pop(str(user_id), None)
+
+
+def _get_cached_index(key, stamp):
+    """Return (index, chunks) if cached for these file mtimes, marking it recently used."""
+    with _index_cache_lock:
+        cached = _index_cache.get(key)
+        if not cached or cached[0] != stamp:
+            return None
+        _index_cache.move_to_end(key)
+        return cached[1], cached[2]
+
+
+def _put_cached_index(key, stamp, index, chunks):
+    """Cache a loaded index, evicting the least recently used users beyond INDEX_CACHE_SIZE."""
+    with _index_cache_lock:
+        _index_cache[key] = (stamp, index, chunks)
+        _index_cache.move_to_end(key)
+        while len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+
+
+def load_user_index(user_id):
+    """
+    Load FAISS index and chunks for a user, cached until the files on disk change.
+    A vector/chunk count mismatch found on load starts a background rebuild; until it
+    finishes no index is returned.
+    """
+    user_dir, vector_cache, index_path = get_user_dirs(user_id)
+    _migrate_legacy_chunks(user_dir, vector_cache)
+    key = str(user_id)
+    if is_index_repairing(user_id):
+        return None, None
+    try:
+        stamp = (os.path.getmtime(index_path), os.path.getmtime(vector_cache))
+    except OSError:
+        evict_cached_index(user_id)
+        return None, None
+
+    cached = _get_cached_index(key, stamp)
+    if cached:
+        return cached
+
+    index, chunks = _read_user_index(user_id, mmap=True)
+    if index is not None and (index.ntotal != chunks.num_rows or is_misnumbered_ivf(index)):
+        if is_misnumbered_ivf(index):
+            print("⚠️ Detected IVF index behind an id map (labels unreliable after deletes).")
+        else:
+            print(f"⚠️ Detected mismatch: {index.ntotal} vectors vs {chunks.num_rows} chunks.")
+        with _repair_lock:
+            start_repair = key not in _repairing_users and chunks.num_rows > 0
+            if start_repair:
+                _repairing_users.add(key)
+        if start_repair:
+            threading.Thread(target=_repair_index, args=(user_id,), daemon=True).start()
+        return None, None
+    if index is not None:
+        index = _prepare_for_search(index)
+        _put_cached_index(key, stamp, index, chunks)
+    return index, chunks
+
+
+@lru_cache(maxsize=1024)
+def _encode_query(text):
+    """Embed a query string; repeated questions skip the model forward pass."""
+    # FP16 models return float16 arrays; FAISS searches in float32
+    query_vec = np.ascontiguousarray(
+        embed_model.encode([text], convert_to_numpy=True, normalize_embeddings=True), dtype=np.float32
+    )
+    query_vec.setflags(write=False)
+    return query_vec
+
+
 # -------------------------------------------------
 # Document Upload & Index Building (Multiple Docs)
 # -------------------------------------------------
-def add_new_document(file_path, user_id):
-    """Add new document chunks to user's FAISS index (append-safe)."""
+def add_new_documents(file_paths, user_id):
+    """
+    Add several documents to user's FAISS index with a single encode + index add (append-safe).
+    Returns the file paths that were indexed.
+    """
     try:
-        print(f"📂 Starting document processing for user {user_id}: {file_path}")
-        chunks = chunk_file(file_path)
-        if not chunks:
-            print("⚠️ No chunks generated — skipping.")
-            return False
+        docs = []
+        for file_path in file_paths:
+            print(f"📂 Starting document processing for user {user_id}: {file_path}")
+            chunks = chunk_file(file_path)
+            if chunks:
+                docs.append((file_path, chunks))
+            else:
+                print(f"⚠️ No chunks generated for {os.path.basename(file_path)} — skipping.")
+        if not docs:
+            return []
 
-        user_dir, vector_cache, index_path = get_user_dirs(user_id)
+        new_chunks = [chunk for _, chunks in docs for chunk in chunks]
+        indexed = [file_path for file_path, _ in docs]
+        with user_index_lock(user_id):
+            user_dir, vector_cache, index_path = get_user_dirs(user_id)
 
-        # Load existing data if available
-        existing_chunks = []
-        index = None
-        if os.path.exists(index_path):
-            index, existing_chunks = load_user_index(user_id)
-            if index is None:
-                print("⚠️ Corrupted index detected. Rebuilding clean index...")
-                all_chunks = (existing_chunks or []) + chunks
-                index, _, _ = build_faiss_index(all_chunks)
-                if index:
-                    save_user_index(user_id, index, all_chunks)
-                    update_metadata(user_id, file_path, len(chunks))
-                    print("✅ Rebuilt full FAISS index.")
-                    return True
-                else:
+            if not os.path.exists(index_path):
+                # First batch: build_faiss_index creates the index and adds the chunks
+                index, _, _ = build_faiss_index(new_chunks)
+                if index is None:
+                    print("❌ Could not create FAISS index.")
+                    return []
+                start, chunk_ids = 0, {}
+                all_chunks = make_chunk_table(range(len(new_chunks)), new_chunks)
+            else:
+                index, existing_chunks = _read_user_index(user_id)
+                chunk_ids = load_chunk_ids(user_id)
+                if index is None or chunk_ids is None or not has_chunk_ids(index):
+                    print("⚠️ Corrupted or legacy index detected. Rebuilding clean index...")
+                    for file_path, chunks in docs:
+                        update_metadata(user_id, file_path, len(chunks))
+                    if rebuild_index_from_files(user_id):
+                        print("✅ Rebuilt full FAISS index.")
+                        return indexed
                     print("❌ Failed to rebuild index.")
-                    return False
-        else:
-            index, _, _ = build_faiss_index(chunks)
-
-        # Create embeddings for new chunks and append
-        if index is not None:
-            print(f"🔢 Adding {len(chunks)} new chunks to FAISS index...")
-            new_embeddings = embed_model.encode(chunks, convert_to_numpy=True, show_progress_bar=False)
-            index.add(np.array(new_embeddings))
-            all_chunks = (existing_chunks or []) + chunks
-            save_user_index(user_id, index, all_chunks)
-            update_metadata(user_id, file_path, len(chunks))
-            print(f"✅ Successfully added {len(chunks)} chunks from {os.path.basename(file_path)}")
-            return True
-        else:
-            print("❌ Could not create FAISS index.")
-            return False
+                    return []
+
+                # Create embeddings for new chunks and append (quantizer range is fixed, no retraining)
+                print(f"🔢 Adding {len(new_chunks)} new chunks from {len(docs)} documents to FAISS index...")
+                last_id = pc.max(existing_chunks.column("id")).as_py()
+                start = 0 if last_id is None else last_id + 1
+                ids = list(range(start, start + len(new_chunks)))
+                new_embeddings = encode_chunks(new_chunks)
+                index.add_with_ids(
+                    np.ascontiguousarray(new_embeddings, dtype=np.float32),
+                    np.asarray(ids, dtype=np.int64),
+                )
+                all_chunks = pa.concat_tables([existing_chunks, make_chunk_table(ids, new_chunks)])
+                ivf = faiss.try_extract_index_ivf(index)
+                if ivf is None and index.ntotal >= IVF_MIN_CHUNKS:
+                    print(f"🧮 Corpus reached {index.ntotal} chunks — converting index to IVFPQ...")
+                    index = upgrade_to_ivf(index)
+                elif ivf is not None and ivf_nlist(index.ntotal) >= IVF_RETRAIN_FACTOR * ivf.nlist:
+                    # nlist records the corpus size the index was trained on; PQ codes are too
+                    # lossy to retrain from, so re-embed the stored chunks
+                    print(f"🧮 Corpus grew to {index.ntotal} chunks (trained for nlist={ivf.nlist}) — retraining IVFPQ...")
+                    retrained, _, _ = build_faiss_index(
+                        all_chunks.column("chunk").to_pylist(), all_chunks.column("id").to_numpy()
+                    )
+                    if retrained is not None:
+                        index = retrained
+
+            for file_path, chunks in docs:
+                chunk_ids.setdefault(os.path.basename(file_path), []).extend(range(start, start + len(chunks)))
+                start += len(chunks)
+            save_user_index(user_id, index, all_chunks, chunk_ids)
+            for file_path, chunks in docs:
+                update_metadata(user_id, file_path, len(chunks))
+                print(f"✅ Successfully added {len(chunks)} chunks from {os.path.basename(file_path)}")
+            return indexed
 
     except Exception as e:
-        print(f"❌ add_new_document() failed: {str(e)}")
+        print(f"❌ add_new_documents() failed: {str(e)}")
         traceback.print_exc()
-        return False
+        return []
+
+
+def add_new_document(file_path, user_id):
+    """Add new document chunks to user's FAISS index (append-safe)."""
+    return bool(add_new_documents([file_path], user_id))
+
+
+def recover_stale_uploads(user_id):
+    """
+    Finish uploads left in "indexing" with no indexing task in this process (e.g. the
+    server stopped mid-way). Files whose chunks already reached the index are marked
+    indexed, the rest are re-added; missing or unreadable files are marked failed.
+    """
+    user_dir, _, _ = get_user_dirs(user_id)
+    metadata_path = os.path.join(user_dir, METADATA_FILE)
+    key = str(user_id)
+    if not os.path.exists(metadata_path):
+        return
+    with _repair_lock:
+        if key in _recovering_users:
+            return
+        _recovering_users.add(key)
+    try:
+        with user_index_lock(user_id):
+            with open(metadata_path, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            stale = {m["file"] for m in metadata if is_orphaned_upload(user_id, m)}
+            if not stale:
+                return
+            print(f"♻️ Recovering {len(stale)} interrupted uploads for user {user_id}...")
+            chunk_ids = load_chunk_ids(user_id) or {}
+            to_index = []
+            for filename in stale:
+                file_path = os.path.join(user_dir, filename)
+                if filename in chunk_ids:
+                    update_metadata(user_id, file_path, len(chunk_ids[filename]))
+                elif os.path.exists(file_path):
+                    to_index.append(file_path)
+                else:
+                    update_metadata(user_id, file_path, 0, "failed")
+            indexed = add_new_documents(to_index, user_id) if to_index else []
+            for file_path in to_index:
+                if file_path not in indexed:
+                    update_metadata(user_id, file_path, 0, "failed")
+    except Exception as e:
+        print(f"⚠️ Could not recover uploads for user {user_id}: {str(e)}")
+        traceback.print_exc()
+    finally:
+        with _repair_lock:
+            _recovering_users.discard(key)
 
 
 # -------------------------------------------------
@@ -333,36 +981,30 @@ def get_response_stream(user_id, query):
     """Generate streamed answers from user's documents (auto-repair + safe)."""
     print(f"💬 Query from user {user_id}: {query}")
 
+    # Vector/chunk mismatches are detected (and repaired in background) on load
     index, chunks = load_user_index(user_id)
 
-    # 🧱 Auto-repair if vector/chunk mismatch
-    if index is not None:
-        total_vectors = index.ntotal
-        chunk_count = len(chunks) if chunks else 0
-        if total_vectors != chunk_count:
-            print(f"⚠️ Detected mismatch: {total_vectors} vectors vs {chunk_count} chunks.")
-            print("🧱 Rebuilding FAISS index automatically...")
-            if chunks:
-                index, _, _ = build_faiss_index(chunks)
-                if index:
-                    save_user_index(user_id, index, chunks)
-                    print("✅ Index rebuilt successfully.")
-                else:
-                    print("❌ Index rebuild failed.")
-                    index = None
-
     # 🧠 Construct query prompt
-    if index is None or not chunks:
+    if index is None and is_index_repairing(user_id):
+        prompt = f"Your documents are being re-indexed right now. Answer this generally:\n\nQ: {query}\nA:"
+    elif index is None or chunks is None or chunks.num_rows == 0:
         prompt = f"You have no uploaded documents. Answer this generally:\n\nQ: {query}\nA:"
     else:
-        query_vec = embed_model.encode([query], convert_to_numpy=True)
-        D, I = index.search(np.array(query_vec), k=3)
-        valid_indices = [i for i in I[0] if i < len(chunks)]
+        query_vec = _encode_query(query)
+        with faiss_gpu_lock:
+            D, I = index.search(query_vec, k=3)
+        # Only the retrieved rows are materialized as Python strings
+        context_chunks = lookup_chunks(chunks, [i for i in I[0] if i >= 0])
 
-        if not valid_indices or D[0][0] > RELEVANCE_THRESHOLD:
+        if index.metric_type == faiss.METRIC_INNER_PRODUCT:
+            relevant = D[0][0] >= COSINE_THRESHOLD
+        else:
+            relevant = D[0][0] <= RELEVANCE_THRESHOLD
+
+        if not context_chunks or not relevant:
             prompt = f"No relevant info found in your uploaded docs. Answer generally:\n\nQ: {query}\nA:"
         else:
-            context = "\n\n".join([chunks[i] for i in valid_indices])
+            context = "\n\n".join(context_chunks)
             prompt = f"Use the context below to answer:\n\nContext:\n{context}\n\nQ: {query}\nA:"
 
     # 🔄 Stream answer from Ollama model
@@ -372,6 +1014,19 @@ def get_response_stream(user_id, query):
         stream=True
     )
 
+    buf = []
+    buffered = 0
+    last_flush = time.monotonic()
     for chunk in stream:
-        if "message" in chunk and "content" in chunk["message"]:
-            yield chunk["message"]["content"]
+        content = (chunk.get("message") or {}).get("content")
+        if not content:
+            continue
+        buf.append(content)
+        buffered += len(content)
+        if buffered >= STREAM_FLUSH_CHARS or time.monotonic() - last_flush > STREAM_FLUSH_SECONDS:
+            yield "".join(buf)
+            buf.clear()
+            buffered = 0
+            last_flush = time.monotonic()
+    if buf:
+        yield "".join(buf)
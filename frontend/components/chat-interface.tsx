@@ -46,6 +46,7 @@ interface ChatHistory {
 
 interface UploadStatus {
   uploading: boolean
+  indexing?: boolean
   fileName?: string
   success?: boolean
   error?: string
@@ -54,9 +55,13 @@ interface UploadStatus {
 interface UserDocumentMeta {
   file: string
   chunks: number
+  status?: "indexing" | "indexed" | "failed"
   uploaded_at: string
 }
 
+const INDEXING_POLL_MS = 2000
+const INDEXING_POLL_LIMIT = 300 // stop polling after ~10 minutes
+
 export function ChatInterface() {
   const router = useRouter()
   const [chatHistories, setChatHistories] = useState<ChatHistory[]>([])
@@ -138,21 +143,33 @@ export function ChatInterface() {
   }, [])
 
   // Fetch user's uploaded docs
-  const fetchUserDocs = async () => {
+  const fetchUserDocs = async (): Promise<UserDocumentMeta[] | null> => {
     const uid = Number(localStorage.getItem("user_id")) || 0
-    if (!uid) return
+    if (!uid) return null
     try {
       const res = await fetch(`http://127.0.0.1:8000/user/${uid}/docs`)
-      if (!res.ok) return
+      if (!res.ok) return null
       const data = await res.json()
       if (Array.isArray(data)) {
         setUserDocs(data as UserDocumentMeta[])
-      } else {
-        setUserDocs(null)
+        return data as UserDocumentMeta[]
       }
+      setUserDocs(null)
     } catch (_) {
       setUserDocs(null)
     }
+    return null
+  }
+
+  // Uploads are indexed in the background; poll the docs list until the file leaves "indexing"
+  const waitForIndexing = async (fileName: string) => {
+    for (let i = 0; i < INDEXING_POLL_LIMIT; i++) {
+      await new Promise((resolve) => setTimeout(resolve, INDEXING_POLL_MS))
+      const docs = await fetchUserDocs()
+      const entry = docs?.filter((d) => d.file === fileName).pop()
+      if (entry && entry.status !== "indexing") return entry.status ?? "indexed"
+    }
+    return "indexing"
   }
 
   useEffect(() => {
@@ -337,19 +354,16 @@ export function ChatInterface() {
       }
 
       const data = await response.json()
-
-      setUploadStatus({
-        uploading: false,
-        fileName: file.name,
-        success: true,
-      })
+      const queued = data.status === "queued"
 
       // refresh user's document list
       fetchUserDocs()
 
       const uploadMessage: Message = {
         id: Date.now().toString(),
-        content: `✅ Successfully uploaded and processed "${file.name}". You can now ask questions about this document!`,
+        content: queued
+          ? `📥 Uploaded "${file.name}" — it is being indexed in the background. You can ask questions about it once it shows as indexed under My Documents.`
+          : `✅ Successfully uploaded and processed "${file.name}". You can now ask questions about this document!`,
         role: "assistant",
         timestamp: new Date(),
       }
@@ -360,6 +374,31 @@ export function ChatInterface() {
       if (fileInputRef.current) {
         fileInputRef.current.value = ""
       }
+
+      let status = "indexed"
+      if (queued) {
+        setUploadStatus({ uploading: true, indexing: true, fileName: file.name })
+        status = await waitForIndexing(file.name)
+      }
+      if (status === "failed") {
+        setUploadStatus({
+          uploading: false,
+          fileName: file.name,
+          error: `Could not index ${file.name}. Please check the file and try again.`,
+        })
+      } else if (status === "indexing") {
+        setUploadStatus({
+          uploading: false,
+          fileName: file.name,
+          error: `${file.name} is still indexing — check My Documents for its status.`,
+        })
+      } else {
+        setUploadStatus({
+          uploading: false,
+          fileName: file.name,
+          success: true,
+        })
+      }
     } catch (error) {
       console.error("Upload error:", error)
       setUploadStatus({
@@ -495,7 +534,9 @@ export function ChatInterface() {
                     <div key={`${d.file}-${idx}`} className="flex items-center justify-between rounded-md border border-purple-200/50 dark:border-purple-800/50 px-2 py-2 text-xs">
                       <div className="truncate mr-2" title={d.file}>{d.file}</div>
                       <div className="flex items-center gap-2">
-                        <div className="text-muted-foreground whitespace-nowrap">{d.chunks} chunks</div>
+                        <div className="text-muted-foreground whitespace-nowrap">
+                          {d.status === "indexing" ? "indexing…" : d.status === "failed" ? "failed" : `${d.chunks} chunks`}
+                        </div>
                         <Button
                           variant="ghost"
                           size="icon"
@@ -743,8 +784,9 @@ export function ChatInterface() {
                         : "text-muted-foreground",
                   )}
                 >
-                  {uploadStatus.uploading && `Uploading ${uploadStatus.fileName}...`}
-                  {uploadStatus.success && `Successfully uploaded ${uploadStatus.fileName}`}
+                  {uploadStatus.uploading &&
+                    (uploadStatus.indexing ? `Indexing ${uploadStatus.fileName}...` : `Uploading ${uploadStatus.fileName}...`)}
+                  {uploadStatus.success && `Successfully uploaded and indexed ${uploadStatus.fileName}`}
                   {uploadStatus.error && uploadStatus.error}
                 </span>
               </div>